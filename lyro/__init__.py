@@ -6,6 +6,7 @@ from .interpreters import (
     Standard,
     ThreadRandomKey,
     Trace,
+    get_interpreter,
     set_interpreter,
 )
 from .runtime import sample
@@ -18,6 +19,7 @@ __all__ = [
     "Standard",
     "ThreadRandomKey",
     "Trace",
+    "get_interpreter",
     "sample",
     "set_interpreter",
 ]
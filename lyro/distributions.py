@@ -1,9 +1,10 @@
 import hashlib
 import json
 from abc import ABC, abstractmethod
+from functools import cached_property
 from typing import Any, Generic, TypeVar
 
-from .random import RandomKey, hash_json
+from .random import RandomKey, canonical_json, fast_hash_json, hash_sha256
 
 V = TypeVar("V")
 
@@ -22,11 +23,52 @@ class Distribution(ABC, Generic[V]):
         pass
 
     def json(self) -> dict:
-        """Converts self to json-serializable format."""
-        return {"class": type(self).__name__, "dict": self.__dict__}
+        """
+        Converts self to json-serializable format.
+
+        Private attributes, i.e. those starting with an underscore, are treated
+        as caches and are omitted.
+        """
+        public = {k: v for k, v in self.__dict__.items() if not k.startswith("_")}
+        return {"class": type(self).__name__, "dict": public}
+
+    @cached_property
+    def _json(self) -> dict:
+        # This is safe to cache because distributions are immutable. It is
+        # kept private and separate from json(), whose callers may mutate it.
+        return self.json()
+
+    @cached_property
+    def _hash(self) -> int:
+        # This is safe to cache because distributions are immutable.
+        return fast_hash_json(self._json)
 
     def __hash__(self) -> int:
-        return hash_json(self.json())
+        return self._hash
+
+    @cached_property
+    def _key_sha256(self) -> "hashlib._Hash":
+        # Persistent keys hash the json of (self.json(), rng.json()). This
+        # caches the hash state of the constant prefix, so that keys for new
+        # rngs need hash only the rng suffix.
+        prefix = "[" + canonical_json(self.json()) + ", "
+        return hashlib.sha256(prefix.encode("utf-8"))
+
+    def key_hash(self, rng: RandomKey) -> int:
+        """
+        Computes a persistent hash of ``(self, rng)``, equal to
+        ``hash_json((self.json(), rng.json()))``.
+        """
+        sha256 = self._key_sha256.copy()
+        sha256.update((json.dumps(rng.json()) + "]").encode("utf-8"))
+        return hash_sha256(sha256)
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, Distribution):
+            return NotImplemented
+        if self is other:
+            return True
+        return self._hash == other._hash and self._json == other._json
 
 
 class UniformHash(Distribution[str]):
@@ -35,10 +77,11 @@ class UniformHash(Distribution[str]):
     def __init__(self, param: Any = None) -> None:
         super().__init__()
         self.param = param
-
-    def __hash__(self) -> int:
-        return hash_json(self)
+        # Hash the constant prefix of the json (param, rng) pair only once.
+        prefix = "[" + canonical_json(param) + ", "
+        self._sha256 = hashlib.sha256(prefix.encode("utf-8"))
 
     async def sample(self, rng: RandomKey) -> str:
-        text = json.dumps((self.param, rng), sort_keys=True)
-        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+        sha256 = self._sha256.copy()
+        sha256.update((json.dumps(rng.json()) + "]").encode("utf-8"))
+        return sha256.hexdigest()
@@ -1,16 +1,40 @@
 import asyncio
+import heapq
 import logging
-from collections import Counter
-from typing import Any, Awaitable, Callable, Dict, List
+import sys
+from array import array
+from collections import Counter, OrderedDict
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Coroutine,
+    Dict,
+    List,
+    Mapping,
+    Sequence,
+    Tuple,
+)
 
 import lyro
 
 from .interpreters import Condition, Trace
-from .openai import Chat, ChatGPT, FusedGPT
+from .openai import ChatGPT, ChatMessage, FusedGPT
 
 logger = logging.getLogger(__name__)
 
 
+class _Overlay(Dict[str, Any]):
+    """A dict of overrides that falls back to a shared base dict."""
+
+    def __init__(self, base: Dict[str, Any], overrides: Dict[str, Any]) -> None:
+        super().__init__(overrides)
+        self.base = base
+
+    def __missing__(self, key: str) -> Any:
+        return self.base[key]
+
+
 class Gibbs:
     """
     Gibbs sampling over static program structure.
@@ -19,23 +43,45 @@ class Gibbs:
         model: A probabilistic model with lyro.sample statements but
             no observe statements.
         data: Observed data on which to condition the model.
+        eager: Whether to eagerly start each inference step's task, running it
+            inline up to its first suspension, e.g. so that memoized steps
+            finish without a trip through the event loop. This requires Python
+            3.12+, and is otherwise ignored. Note this changes the order in
+            which steps are scheduled, and hence which random keys each step
+            consumes, so results will differ from non-eager runs.
+        max_inflight: The maximum number of inference steps to run
+            concurrently, e.g. to stay within API rate limits.
     """
 
     trace: Trace
-    markov_blanket: Dict[str, List[str]]
+    likelihood_cache_size = 1024
+    markov_blanket: Mapping[str, Sequence[str]]
 
     def __init__(
         self,
         model: Callable[[], Awaitable],
         data: Dict[str, Any],
-        markov_blanket: Dict[str, List[str]] | None = None,
+        markov_blanket: Mapping[str, Sequence[str]] | None = None,
+        *,
+        eager: bool = False,
+        max_inflight: int = 16,
     ) -> None:
+        assert max_inflight > 0
         super().__init__()
         self.model = model
         self.data = data
-        self.tasks: Dict[str, asyncio.Task] = {}
-        self.counts: Counter[str] = Counter()  # #completed inference steps per site
+        self.eager = eager
+        self.max_inflight = max_inflight
+        if markov_blanket is not None:
+            self.markov_blanket = markov_blanket
+        self._starting = False
+        self._idle: asyncio.Future[None]  # Created per call to .sample().
+        self.tasks: List[asyncio.Task | None] = []  # running task per site id
+        self.counts = array("q")  # #completed inference steps per site id
         self.num_pending = 0
+        self._likelihoods: OrderedDict[tuple, Tuple[Sequence[ChatMessage], ...]]
+        self._likelihoods = OrderedDict()  # LRU cache for .get_likelihoods()
+        self._structure: tuple | None = None  # latent sites and blanket
 
     async def _init(self) -> None:
         """Initializes inference.."""
@@ -45,53 +91,157 @@ class Gibbs:
             await self.model()
 
         # Validate data.
-        assert set(self.data) <= set(self.trace.nodes)
+        assert self.data.keys() <= self.trace.nodes.keys()
+        self._values = {name: site.value for name, site in self.trace.nodes.items()}
+        self._likelihoods.clear()
 
         # Restrict to latent variables.
-        nodes = {
-            name: node
-            for name, node in self.trace.nodes.items()
-            if name not in self.data
-        }
+        latent = tuple(name for name in self.trace.nodes if name not in self.data)
 
         # Track dependencies.
         if not hasattr(self, "markov_blanket"):
-            # Default to the simple complete blanket dependency.
-            self.markov_blanket = {name: list(nodes) for name in nodes}
-
-        # We use reverse rank to quickly recover from the initial trace that
-        # is biased towards the prior and ignores observations.
-        self.rank = {name: i for i, name in enumerate(reversed(nodes))}
-
-    def _find_work(self) -> str | None:
-        # Find all currently feasible tasks.
-        slowest = min(self.counts.values()) if self.counts else 0
-        feasible = [
-            name
-            for name, deps in self.markov_blanket.items()
-            if name not in self.tasks  # don't duplicate work
-            if not any(dep in self.tasks for dep in deps)  # avoid conflict
-            if self.counts[name] <= slowest  # don't get too far ahead
+            # Default to the simple complete blanket dependency, sharing one
+            # tuple across all sites rather than copying it per site. Order
+            # matters: it determines the order of likelihoods in prompts.
+            self.markov_blanket = {name: latent for name in latent}
+
+        # Reuse site tables across calls while the structure is unchanged.
+        structure = (latent, {k: tuple(v) for k, v in self.markov_blanket.items()})
+        if structure != self._structure:
+            self._structure = structure
+
+            # We use reverse rank to quickly recover from the initial trace
+            # that is biased towards the prior and ignores observations.
+            self.rank = {name: i for i, name in enumerate(reversed(latent))}
+
+            # Intern latent site names as small ints, and represent sets of
+            # sites as bitmasks, so that feasibility is a single AND.
+            self._names = list(latent)
+            self._ids = {name: i for i, name in enumerate(self._names)}
+            # Symmetrize blankets for conflicts, so that a site never runs
+            # concurrently with a dependent, even if blankets are asymmetric.
+            self._blanket_masks = [0] * len(self._names)
+            dependents: List[List[str]] = [[] for _ in self._names]
+            for name, deps in self.markov_blanket.items():
+                if name not in self._ids:
+                    continue  # Observed sites are never sampled.
+                i = self._ids[name]
+                for dep in deps:
+                    if dep in self._ids:  # Observed sites never conflict.
+                        j = self._ids[dep]
+                        self._blanket_masks[i] |= 1 << j
+                        self._blanket_masks[j] |= 1 << i
+                        if dep != name:
+                            dependents[j].append(name)
+            self._dependents = [tuple(d) for d in dependents]  # reverse blanket
+
+            # Likelihoods depend on the blanket and on each neighbor's own
+            # blanket, e.g. a grandparent in a neighbor's prompt, so key their
+            # cache on all these sites. Default to all sites if unknown.
+            self._likelihood_deps: Dict[str, Tuple[str, ...]] = {}
+            for name, deps in self.markov_blanket.items():
+                key_sites = dict.fromkeys(deps)
+                for neighbor in deps:
+                    if neighbor == name:
+                        continue
+                    if neighbor not in self.markov_blanket:
+                        key_sites = dict.fromkeys(self.trace.nodes)
+                        break
+                    key_sites.update(dict.fromkeys(self.markov_blanket[neighbor]))
+                key_sites.pop(name, None)
+                self._likelihood_deps[name] = tuple(key_sites)
+        self._running_mask = 0
+        self.tasks = [None] * len(self._names)
+        if len(self.counts) != len(self._names):
+            self.counts = array("q", [0] * len(self._names))
+
+        # Track the slowest started site via a histogram of nonzero counts.
+        self._count_hist = Counter(count for count in self.counts if count)
+        self._slowest = min(self._count_hist, default=0)
+
+        # Queue idle sites by priority (count, rank, id).
+        self._queue = [
+            (self.counts[self._ids[name]], self.rank[name], self._ids[name])
+            for name in self.markov_blanket
+            if name in self._ids
         ]
-        if not feasible:
-            return None
+        heapq.heapify(self._queue)
 
-        # Find the best task to perform, based on previous execution count.
-        best = min(feasible, key=lambda name: (self.counts[name], self.rank[name]))
-        self.counts[best] += 1
+    def _find_work(self) -> int | None:
+        """Finds the best feasible task, based on previous execution count."""
+        # Note only sites that have been started count towards the slowest.
+        slowest = self._slowest
+        blocked = []
+        best = None
+        while self._queue:
+            count, _, i = self._queue[0]
+            if count > slowest:
+                break  # don't get too far ahead
+            entry = heapq.heappop(self._queue)
+            if self._blanket_masks[i] & self._running_mask:
+                blocked.append(entry)  # avoid conflict
+                continue
+            best = i
+            break
+        for entry in blocked:
+            heapq.heappush(self._queue, entry)
+        if best is None:
+            return None
+        count = self.counts[best]
+        self.counts[best] = count + 1
+        self._count_hist[count + 1] += 1
+        if count:
+            self._count_hist[count] -= 1
+            if not self._count_hist[count]:
+                del self._count_hist[count]
+                if count == slowest:
+                    self._slowest = count + 1
+        else:
+            self._slowest = 1
         return best
 
     def _start_work(self) -> None:
         """Starts as much work as possible."""
-        while self.num_pending:
-            name = self._find_work()
-            if name is None:
-                return
-            assert name not in self.tasks
-            self.num_pending -= 1
-            self.tasks[name] = asyncio.create_task(self._do_work(name))
-
-    async def _do_work(self, name: str) -> None:
+        if self._starting:
+            return  # An eager task finished; the outer loop will continue.
+        self._starting = True
+        try:
+            while self.num_pending and not self._idle.done():
+                if self._running_mask.bit_count() >= self.max_inflight:
+                    break
+                i = self._find_work()
+                if i is None:
+                    break
+                assert self.tasks[i] is None
+                self.num_pending -= 1
+                self._running_mask |= 1 << i
+                task = self._create_task(self._do_work(i))
+                if task.done():
+                    self._task_done(task)  # An eager task finished inline.
+                else:
+                    task.add_done_callback(self._task_done)
+                    self.tasks[i] = task
+        finally:
+            self._starting = False
+        if not self._running_mask and not self._idle.done():
+            self._idle.set_result(None)
+
+    def _task_done(self, task: asyncio.Task) -> None:
+        """Forwards the first task error to :meth:`sample`."""
+        if task.cancelled():
+            return
+        error = task.exception()
+        if error is not None and not self._idle.done():
+            self._idle.set_exception(error)
+
+    def _create_task(self, coro: Coroutine[Any, Any, None]) -> asyncio.Task:
+        if self.eager and sys.version_info >= (3, 12):
+            loop = asyncio.get_running_loop()
+            return asyncio.Task(coro, loop=loop, eager_start=True)
+        return asyncio.create_task(coro)
+
+    async def _do_work(self, i: int) -> None:
+        name = self._names[i]
         logger.debug(f"Gibbs step at site {repr(name)}")
         node = self.trace.nodes[name]
 
@@ -104,24 +254,29 @@ class Gibbs:
         # Draw a local sample.
         try:
             # Draw a local posterior sample at this site.
-            with Trace() as trace:
-                value = await lyro.sample(name, local_posterior)
-            data = {k: site.value for k, site in self.trace.nodes.items()}
-            data[name] = value
-
-            # Rerun model to update all distributions.
-            with Trace() as trace, Condition(data):
-                # WARNING if model ever cedes control, the subsequent .update()
-                # may be stale.
-                await self.model()
-            self.trace.nodes.update(trace.nodes)
+            value = await lyro.sample(name, local_posterior)
+            self._values[name] = value
+            node = self.trace.nodes[name]
+            self.trace.nodes[name] = node._replace(value=value)
+
+            # Refresh distributions of dependent sites by rerunning the model
+            # with all sites conditioned. Note dependents cannot be running,
+            # since conflicts are symmetric: no site runs concurrently with a
+            # site whose blanket contains it.
+            if self._dependents[i]:
+                with Condition(self._values), Trace() as trace:
+                    await self.model()
+                for dependent in self._dependents[i]:
+                    self.trace.nodes[dependent] = trace.nodes[dependent]
         except asyncio.CancelledError:
             raise
         except Exception as e:
             logger.exception(e)
             raise
         finally:
-            self.tasks.pop(name)
+            self.tasks[i] = None
+            self._running_mask &= ~(1 << i)
+            heapq.heappush(self._queue, (self.counts[i], self.rank[name], i))
 
         # Check for more work.
         self._start_work()
@@ -132,23 +287,27 @@ class Gibbs:
 
         # Run inference.
         self.num_pending = num_steps
+        self._idle = asyncio.get_running_loop().create_future()
         try:
             await self._init()
             self._start_work()
-        except asyncio.CancelledError:
+            await self._idle  # Resolved once the last running task finishes.
+        except BaseException:
+            # Cancel and wait for running tasks, so none outlive this call.
             self.num_pending = 0
-            for task in self.tasks.values():
+            running = [task for task in self.tasks if task is not None]
+            for task in running:
                 task.cancel()
-            self.tasks.clear()
+            await asyncio.gather(*running, return_exceptions=True)
+            self.tasks = [None] * len(self.tasks)
+            self._running_mask = 0
             raise
-        while self.tasks:
-            await asyncio.gather(*self.tasks.values())
         assert self.num_pending == 0
 
         # Validate final state.
-        assert all(
-            self.trace.nodes[name].value == value for name, value in self.data.items()
-        )
+        if __debug__:
+            for name, value in self.data.items():
+                assert self.trace.nodes[name].value == value
 
         # Return posterior samples of latent variables.
         return {
@@ -157,19 +316,40 @@ class Gibbs:
             if name not in self.data
         }
 
-    async def get_likelihoods(self, name: str, value: str) -> List[Chat]:
-        # Construct data with a placeholder.
-        data = {n: site.value for n, site in self.trace.nodes.items()}
-        data[name] = value
+    async def get_likelihoods(
+        self, name: str, value: str
+    ) -> List[Sequence[ChatMessage]]:
+        # Reuse likelihoods while the values they depend on are unchanged.
+        blanket = self.markov_blanket[name]
+        deps = self._likelihood_deps[name]
+        key = (name, value, tuple(self._values.get(n) for n in deps))
+        try:
+            cached = self._likelihoods[key]
+        except KeyError:
+            cacheable = True
+        except TypeError:
+            cacheable = False  # Values are unhashable.
+        else:
+            self._likelihoods.move_to_end(key)
+            return list(cached)
+
+        # Construct data with a placeholder, without copying all values.
+        data = _Overlay(self._values, {name: value})
         with Condition(data), Trace() as trace:
             await self.model()
 
         # Extract messages from all neighbors in the Markov blanket.
-        result: List[Chat] = []
-        for neighbor in self.markov_blanket[name]:
+        result: List[Sequence[ChatMessage]] = []
+        for neighbor in blanket:
             if neighbor == name:
                 continue
             node = trace.nodes[neighbor]
             assert isinstance(node.distribution, ChatGPT)
             result.append(node.distribution.messages)
+
+        # Cache only if the rerun was fully determined, i.e. sampled no new sites.
+        if cacheable and all(n in self._values for n in trace.nodes):
+            self._likelihoods[key] = tuple(result)
+            if len(self._likelihoods) > self.likelihood_cache_size:
+                self._likelihoods.popitem(last=False)
         return result
@@ -1,12 +1,25 @@
+import asyncio
 import functools
 import json
 import os
 import sqlite3
+import weakref
 from abc import ABC, abstractmethod
-from typing import Any, Awaitable, Callable, Dict, Generic, NamedTuple, TypeVar
+from collections import OrderedDict
+from contextvars import ContextVar
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    Generic,
+    NamedTuple,
+    Tuple,
+    TypeVar,
+)
 
 from .distributions import Distribution, V
-from .random import RandomKey, hash_json
+from .random import MASK64, RandomKey
 
 T = TypeVar("T")
 
@@ -23,7 +36,8 @@ class Interpreter(ABC):
         pass
 
     def __enter__(self) -> "Interpreter":
-        self.base = INTERPRETER
+        self.base = INTERPRETER.get()
+        _fuse(self)
         set_interpreter(self)
         return self
 
@@ -36,6 +50,7 @@ class Interpreter(ABC):
     def __add__(self, other: "Interpreter") -> "Interpreter":
         """Stack interpreters, e.g. inner + middle + outer."""
         other.base = self
+        _fuse(other)
         return other
 
 
@@ -88,12 +103,68 @@ class ThreadRandomKey(Interpreter):
         return await self.base.sample(name, distribution, rng)
 
 
+_MISSING = object()
+
+
+async def _coalesce(
+    inflight: Dict[int, Tuple[Distribution, RandomKey, asyncio.Future]],
+    key: int,
+    distribution: Distribution[V],
+    rng: RandomKey,
+    sample: Callable[[], Awaitable[V]],
+    save: Callable[[V], None],
+) -> V:
+    """
+    Computes and saves a missing value, sharing it with any concurrent calls
+    for the same distribution and rng rather than sampling again.
+    """
+    entry = inflight.get(key)
+    if entry is not None and entry[0] == distribution and entry[1] == rng:
+        await asyncio.wait([entry[2]])  # Note this never cancels the future.
+        if not entry[2].cancelled():
+            result: V = entry[2].result()
+            return result
+        entry = inflight.get(key)  # The first call was cancelled, so retry.
+
+    # On the rare key collision, compute without sharing.
+    future = asyncio.get_running_loop().create_future()
+    owner = entry is None
+    if owner:
+        inflight[key] = (distribution, rng, future)
+    try:
+        value = await sample()
+    except asyncio.CancelledError:
+        future.cancel()
+        raise
+    except BaseException as e:
+        future.set_exception(e)
+        future.exception()  # Avoid logging when there are no other callers.
+        raise
+    finally:
+        if owner:
+            del inflight[key]
+    future.set_result(value)
+    save(value)
+    return value
+
+
 class Memoize(Interpreter):
-    """Memoize in memory."""
+    """
+    Memoize in memory.
 
-    def __init__(self) -> None:
+    Args:
+        probability: The fraction of new results to save, deterministically
+            every ``1 / probability``-th result. Lower values bound cache size,
+            at the cost of recomputing, and hence resampling, unsaved results.
+    """
+
+    def __init__(self, probability: float = 1.0) -> None:
         super().__init__()
-        self.cache: Dict[int, Any] = {}
+        assert 0 <= probability <= 1
+        self.probability = probability
+        self._credit = 0.0  # accumulates probability until a result is saved
+        self.cache: Dict[int, Tuple[Distribution, RandomKey, Any]] = {}
+        self._inflight: Dict[int, Tuple[Distribution, RandomKey, asyncio.Future]] = {}
 
     async def sample(
         self, name: str, distribution: Distribution[V], rng: RandomKey | None = None
@@ -101,25 +172,84 @@ class Memoize(Interpreter):
         if rng is None:
             raise ValueError("Missing rng, try adding a ThreadRandomKey")
 
-        key = hash((distribution, rng))
-        if key not in self.cache:
-            self.cache[key] = await self.base.sample(name, distribution, rng)
-        value: V = self.cache[key]
+        key = self._key(distribution, rng)
+        value: V = self._get(key, distribution, rng)
+        if value is _MISSING:
+            value = await _coalesce(
+                self._inflight,
+                key,
+                distribution,
+                rng,
+                functools.partial(self.base.sample, name, distribution, rng),
+                functools.partial(self._put, key, distribution, rng),
+            )
         return value
 
+    @staticmethod
+    def _key(distribution: Distribution, rng: RandomKey) -> int:
+        # Combine precomputed hashes into an int key, rotating the rng hash so
+        # that the combination is asymmetric.
+        h = rng._hash
+        return distribution._hash ^ (((h << 17) | (h >> 47)) & MASK64)
+
+    def _get(self, key: int, distribution: Distribution, rng: RandomKey) -> Any:
+        """Returns a cached value, or _MISSING."""
+        entry = self.cache.get(key)
+        if entry is not None and entry[0] == distribution and entry[1] == rng:
+            return entry[2]
+        return _MISSING
+
+    def _put(self, key: int, distribution: Distribution, rng: RandomKey, value) -> None:
+        self._credit += self.probability
+        if self._credit < 1:
+            return
+        self._credit -= 1
+        # On the rare collision, keep the first entry.
+        self.cache.setdefault(key, (distribution, rng, value))
+
 
 class MemoizeSqlite(Interpreter):
-    """Memoize in a sqlite database."""
+    """
+    Memoize in a sqlite database.
 
-    def __init__(self, dbname: str) -> None:
-        super().__init__()
+    New results are written behind, in batches: they are saved on the next
+    event loop tick, or earlier whenever :meth:`flush` is called or this
+    interpreter is exited. Results left unsaved, e.g. by a closed event loop,
+    are saved on :meth:`close`, garbage collection, or process exit.
+
+    The set of saved keys is loaded once, so that cache misses skip the
+    database. Hence results saved by other processes after construction are
+    not reused.
+
+    Args:
+        dbname: The path of the sqlite database file.
+        probability: The fraction of new results to save, as in
+            :class:`Memoize`.
+    """
 
-        # Initialize the database.
+    hot_cache_size = 1024
+
+    def __init__(self, dbname: str, probability: float = 1.0) -> None:
+        super().__init__()
+        assert 0 <= probability <= 1
+        self.probability = probability
+        self._credit = 0.0  # accumulates probability until a result is saved
+        self._hot: OrderedDict[int, Any] = OrderedDict()  # recently used values
+        self._inflight: Dict[int, Tuple[Distribution, RandomKey, asyncio.Future]] = {}
+        self._pending: Dict[int, str] = {}  # results not yet saved
+        self._flush_loop: asyncio.AbstractEventLoop | None = None  # if pending
+
+        # Initialize the database, keeping one connection open for reuse.
         self.dbname = os.path.abspath(dbname)
         os.makedirs(os.path.dirname(self.dbname), exist_ok=True)
-        with sqlite3.connect(self.dbname) as conn:
-            cursor = conn.cursor()
-            cursor.execute(
+        self._conn = sqlite3.connect(self.dbname, check_same_thread=False)
+        # Note we avoid journal_mode=WAL, which would be persisted to the file.
+        self._conn.execute("PRAGMA synchronous = NORMAL")
+        self._conn.execute("PRAGMA temp_store = MEMORY")
+        self._conn.execute("PRAGMA mmap_size = 268435456")  # 256MB
+        self._conn.execute("PRAGMA cache_size = -65536")  # 64MB
+        with self._conn:
+            self._conn.execute(
                 """
                 CREATE TABLE IF NOT EXISTS key_value (
                     key_hash INTEGER PRIMARY KEY,
@@ -127,6 +257,12 @@ class MemoizeSqlite(Interpreter):
                 )
                 """
             )
+        cursor = self._conn.execute("SELECT key_hash FROM key_value")
+        self._keys = {key_hash for (key_hash,) in cursor}  # saved keys
+
+        # Save pending results even if no scheduled flush ever runs,
+        # e.g. after its loop was closed.
+        self._finalizer = weakref.finalize(self, _close, self._conn, self._pending)
 
     async def sample(
         self, name: str, distribution: Distribution[V], rng: RandomKey | None = None
@@ -134,32 +270,99 @@ class MemoizeSqlite(Interpreter):
         if rng is None:
             raise ValueError("Missing rng, try adding a ThreadRandomKey")
 
-        # Try to reuse old result.
-        key = distribution.json(), rng
-        key_hash = hash_json(key)
-        print("DEBUG", key, key_hash)
-        with sqlite3.connect(self.dbname) as conn:
-            cursor = conn.cursor()
-            cursor.execute(
+        # Try to reuse old result, including results not yet saved.
+        key_hash = distribution.key_hash(rng)
+        value: V
+        try:
+            value = self._hot[key_hash]
+        except KeyError:
+            pass
+        else:
+            self._hot.move_to_end(key_hash)
+            return value
+        value_json = self._pending.get(key_hash)
+        if value_json is None and key_hash in self._keys:
+            row = self._conn.execute(
                 "SELECT value_json FROM key_value WHERE key_hash = ?", (key_hash,)
-            )
-            row = cursor.fetchone()
+            ).fetchone()
             if row is not None:
-                value: V = json.loads(row[0])
-                return value
+                value_json = row[0]
+        if value_json is not None:
+            value = json.loads(value_json)
+            self._remember(key_hash, value)
+            return value
 
         # Compute new result.
-        value = await self.base.sample(name, distribution, rng)
-
-        # Save for later.
-        value_json = json.dumps(value)
-        with sqlite3.connect(self.dbname) as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                "INSERT OR IGNORE INTO key_value VALUES (?, ?)", (key_hash, value_json)
-            )
+        value = await _coalesce(
+            self._inflight,
+            key_hash,
+            distribution,
+            rng,
+            functools.partial(self.base.sample, name, distribution, rng),
+            functools.partial(self._save, key_hash),
+        )
         return value
 
+    def _save(self, key_hash: int, value: Any) -> None:
+        """Saves a new result for later."""
+        self._credit += self.probability
+        if self._credit < 1:
+            return
+        self._credit -= 1
+        if key_hash not in self._pending:
+            self._pending[key_hash] = json.dumps(value)
+            self._remember(key_hash, value)
+        # Schedule a flush unless one is pending on the running loop. Note a
+        # flush left pending on a closed loop never runs.
+        loop = asyncio.get_running_loop()
+        if self._flush_loop is not loop:
+            self._flush_loop = loop
+            loop.call_soon(self._flush_soon)
+
+    def _flush_soon(self) -> None:
+        self._flush_loop = None
+        self.flush()
+
+    def flush(self) -> None:
+        """Saves all pending results to the database, in one transaction."""
+        if not self._pending:
+            return
+        _write(self._conn, self._pending)
+        self._keys.update(self._pending)
+        self._pending.clear()
+
+    def _remember(self, key_hash: int, value: Any) -> None:
+        """Adds a decoded result to the in-memory LRU cache."""
+        self._hot[key_hash] = value
+        self._hot.move_to_end(key_hash)
+        if len(self._hot) > self.hot_cache_size:
+            self._hot.popitem(last=False)
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.flush()
+        super().__exit__(exc_type, exc_value, traceback)
+
+    def close(self) -> None:
+        """Saves all pending results and closes the database connection."""
+        self.flush()
+        self._finalizer()
+
+
+def _write(conn: sqlite3.Connection, pending: Dict[int, str]) -> None:
+    """Writes pending results to a database, in one transaction."""
+    with conn:
+        conn.executemany(
+            "INSERT OR IGNORE INTO key_value VALUES (?, ?)", list(pending.items())
+        )
+
+
+def _close(conn: sqlite3.Connection, pending: Dict[int, str]) -> None:
+    """Finalizes a :class:`MemoizeSqlite` database, saving pending results."""
+    if pending:
+        _write(conn, pending)
+        pending.clear()
+    conn.close()
+
 
 class TraceNode(NamedTuple):
     name: str
@@ -223,10 +426,97 @@ class If(Interpreter):
         return await self.base.sample(name, distribution, rng)
 
 
-INTERPRETER: Interpreter = BASE + Memoize() + ThreadRandomKey()
+def _fuse(interpreter: Interpreter) -> None:
+    """
+    Fuses common interpreter stacks into single coroutines, avoiding nested
+    coroutine calls per sample. This is called whenever an interpreter's base
+    is linked.
+    """
+    interpreter.__dict__.pop("sample", None)
+    fuser = _FUSERS.get(type(interpreter))
+    if fuser is not None:
+        sample = fuser(interpreter)
+        if sample is not None:
+            interpreter.__dict__["sample"] = sample
+
+
+def _fuse_thread_random_key(thread: Interpreter) -> Callable | None:
+    """Fuses the default ``Standard() + Memoize() + ThreadRandomKey()`` stack."""
+    assert isinstance(thread, ThreadRandomKey)
+    memoize = thread.base
+    if type(memoize) is not Memoize:
+        return None
+    standard = memoize.base
+    if type(standard) is not Standard:
+        return None
+    unfused = functools.partial(ThreadRandomKey.sample, thread)
+
+    async def sample(
+        name: str, distribution: Distribution[V], rng: RandomKey | None = None
+    ) -> V:
+        assert isinstance(memoize, Memoize)
+        if thread.base is not memoize or memoize.base is not standard:
+            return await unfused(name, distribution, rng)  # Relinked since fusing.
+        if rng is None or thread.force:
+            rng, thread.rng = thread.rng.split()
+        key = memoize._key(distribution, rng)
+        value: V = memoize._get(key, distribution, rng)
+        if value is _MISSING:
+            value = await _coalesce(
+                memoize._inflight,
+                key,
+                distribution,
+                rng,
+                functools.partial(distribution.sample, rng),
+                functools.partial(memoize._put, key, distribution, rng),
+            )
+        return value
+
+    return sample
+
+
+def _fuse_trace(trace: Interpreter) -> Callable | None:
+    """Fuses a ``Trace()`` over a ``Condition()``, as used by inference."""
+    assert isinstance(trace, Trace)
+    condition = trace.base
+    if type(condition) is not Condition:
+        return None
+    unfused = functools.partial(Trace.sample, trace)
+
+    async def sample(
+        name: str, distribution: Distribution[V], rng: RandomKey | None = None
+    ) -> V:
+        assert isinstance(condition, Condition)
+        if trace.base is not condition:
+            return await unfused(name, distribution, rng)  # Relinked since fusing.
+        try:
+            value: V = condition.data[name]
+        except KeyError:
+            value = await condition.base.sample(name, distribution, rng)
+        trace.nodes[name] = TraceNode(name, distribution, rng, value)
+        return value
+
+    return sample
+
+
+_FUSERS: Dict[type, Callable[[Any], Callable | None]] = {
+    ThreadRandomKey: _fuse_thread_random_key,
+    Trace: _fuse_trace,
+}
+
+# The current interpreter is context-local, so that concurrent asyncio tasks,
+# which each run in a copy of their creator's context, can each enter their own
+# interpreters without clobbering one another.
+INTERPRETER: ContextVar[Interpreter] = ContextVar(
+    "INTERPRETER", default=BASE + Memoize() + ThreadRandomKey()
+)
+
+
+def get_interpreter() -> Interpreter:
+    """Gets the current interpreter."""
+    return INTERPRETER.get()
 
 
 def set_interpreter(interpreter: Interpreter = BASE) -> None:
-    """Sets the global interpreter."""
-    global INTERPRETER
-    INTERPRETER = interpreter
+    """Sets the current interpreter, in the current context."""
+    INTERPRETER.set(interpreter)
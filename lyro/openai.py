@@ -1,12 +1,27 @@
+import asyncio
 import copy
+import functools
+import hashlib
 import logging
 import textwrap
-from typing import Any, Dict, List, Literal, TypedDict
-
+from functools import cached_property
+from typing import (
+    Any,
+    AsyncGenerator,
+    Dict,
+    List,
+    Literal,
+    Sequence,
+    Set,
+    Tuple,
+    TypedDict,
+)
+
+import aiohttp
 import openai
 
 from .distributions import Distribution
-from .random import RandomKey
+from .random import RandomKey, canonical_json
 
 logger = logging.getLogger(__name__)
 
@@ -19,6 +34,29 @@ class ChatMessage(TypedDict):
 Chat = List[ChatMessage]
 
 
+@functools.lru_cache(maxsize=4096)
+def _message_json(role: str, content: str) -> str:
+    return canonical_json({"content": content, "role": role})
+
+
+def _messages_json(messages: Sequence[ChatMessage]) -> str:
+    """
+    Serializes messages to canonical json, as in ``canonical_json(messages)``.
+
+    This caches the serialization of each message, so that distributions over a
+    growing chat history serialize only the new messages.
+    """
+    parts = [
+        (
+            _message_json(m["role"], m["content"])
+            if m.keys() == {"role", "content"} and isinstance(m["content"], str)
+            else canonical_json(m)
+        )
+        for m in messages
+    ]
+    return "[" + ", ".join(parts) + "]"
+
+
 def system(content: str) -> ChatMessage:
     """Helper to construct a system message."""
     return ChatMessage(role="system", content=content)
@@ -34,6 +72,136 @@ def assistant(content: str) -> ChatMessage:
     return ChatMessage(role="assistant", content=content)
 
 
+_BatchKey = Tuple[asyncio.AbstractEventLoop, str]
+_SessionEntry = Tuple[
+    aiohttp.ClientSession, AsyncGenerator[aiohttp.ClientSession, None]
+]
+
+
+class ChatBatcher:
+    """
+    Coalesces concurrent identical chat requests into a single request.
+
+    Requests arriving within ``window`` seconds of each other with identical
+    parameters are sent as one API call with ``n`` set to the number of
+    requests, and each caller receives a distinct choice. A batch is sent early
+    once it reaches ``max_batch`` requests.
+
+    All requests on an event loop share one HTTP session, so connections are
+    kept alive across requests rather than reopened per request. The session
+    is closed when the loop shuts down, or earlier by :meth:`aclose`.
+    """
+
+    def __init__(
+        self, window: float = 0.01, max_batch: int = 16, max_connections: int = 100
+    ) -> None:
+        super().__init__()
+        assert max_batch > 0
+        assert max_connections > 0
+        self.window = window
+        self.max_batch = max_batch
+        self.max_connections = max_connections
+        self._batches: Dict[_BatchKey, List[asyncio.Future]] = {}
+        self._timers: Dict[_BatchKey, asyncio.TimerHandle] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        self._sessions: Dict[asyncio.AbstractEventLoop, _SessionEntry] = {}
+
+    async def create(self, request: Dict[str, Any]) -> dict:
+        """Creates a single chat completion choice."""
+        # Batches are per event loop, since futures and timers are bound to one.
+        loop = asyncio.get_running_loop()
+        key = loop, canonical_json(request)
+        batch = self._batches.get(key)
+        if batch is None:
+            batch = self._batches[key] = []
+            timer = loop.call_later(self.window, self._flush, key, request)
+            self._timers[key] = timer
+        future = loop.create_future()
+        batch.append(future)
+        if len(batch) >= self.max_batch:
+            self._timers[key].cancel()
+            self._flush(key, request)
+        try:
+            choice: dict = await future
+        except asyncio.CancelledError:
+            # Drop a batch whose callers were all cancelled, e.g. by timeouts.
+            if self._batches.get(key) is batch and all(f.done() for f in batch):
+                self._timers.pop(key).cancel()
+                del self._batches[key]
+            raise
+        return choice
+
+    async def aclose(self) -> None:
+        """
+        Closes the HTTP session of the running event loop, if any. This is
+        called automatically when the loop shuts down its async generators,
+        e.g. at the end of :func:`asyncio.run`.
+        """
+        entry = self._sessions.pop(asyncio.get_running_loop(), None)
+        if entry is not None:
+            await entry[1].aclose()
+
+    async def _session(self) -> aiohttp.ClientSession:
+        # Sessions are bound to an event loop, so keep one per loop.
+        loop = asyncio.get_running_loop()
+        entry = self._sessions.get(loop)
+        if entry is None:
+            holder = self._hold_session(loop)
+            entry = self._sessions[loop] = await holder.__anext__(), holder
+        return entry[0]
+
+    async def _hold_session(
+        self, loop: asyncio.AbstractEventLoop
+    ) -> AsyncGenerator[aiohttp.ClientSession, None]:
+        # Hold a session open in an async generator, which its loop closes on
+        # shutdown, so that sessions never outlive their loop.
+        connector = aiohttp.TCPConnector(limit=self.max_connections)
+        session = aiohttp.ClientSession(connector=connector)
+        try:
+            yield session
+        finally:
+            entry = self._sessions.get(loop)
+            if entry is not None and entry[0] is session:
+                del self._sessions[loop]
+            await session.close()
+
+    def _flush(self, key: _BatchKey, request: Dict[str, Any]) -> None:
+        del self._timers[key]
+        batch = [f for f in self._batches.pop(key) if not f.done()]
+        if batch:
+            task = asyncio.create_task(self._send(request, batch))
+            self._tasks.add(task)  # Keep a reference until done.
+            task.add_done_callback(self._tasks.discard)
+
+    async def _send(
+        self, request: Dict[str, Any], futures: List[asyncio.Future]
+    ) -> None:
+        try:
+            if len(futures) > 1:
+                request = dict(request, n=len(futures))
+            # Call the async non-streaming API. By default openai opens a new
+            # session per request; this task's context instead shares ours.
+            openai.aiosession.set(await self._session())
+            raw_response = await openai.ChatCompletion.acreate(**request)
+            response: dict = raw_response.to_dict_recursive()
+            choices = response["choices"]
+            if len(choices) != len(futures):
+                raise ValueError(
+                    f"Expected {len(futures)} choices, but got {len(choices)}"
+                )
+        except Exception as e:
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for future, choice in zip(futures, choices):
+            if not future.done():
+                future.set_result(choice)
+
+
+BATCHER = ChatBatcher()
+
+
 class ChatGPT(Distribution[str]):
     """
     GPT distribution over chat messages, conditioned on chat history.
@@ -42,56 +210,75 @@ class ChatGPT(Distribution[str]):
     OPENAI_API_ORG and OPENAI_API_KEY.
     """
 
+    messages: Tuple[ChatMessage, ...]
+
     def __init__(
         self,
-        messages: List[ChatMessage],
+        messages: Sequence[ChatMessage],
         *,
         model: str = "gpt-3.5-turbo",
         temperature: float = 1.0,
         max_tokens: int | None = None,
     ) -> None:
         super().__init__()
-        self.messages = copy.deepcopy(messages)
+        # Shallow copies suffice, since message values are immutable strings.
+        self.messages = tuple(map(copy.copy, messages))
         self.model = model
         self.temperature = temperature
         self.max_tokens = max_tokens
 
+    @cached_property
+    def _key_sha256(self) -> "hashlib._Hash":
+        # This equals Distribution._key_sha256, but splices in _messages_json(),
+        # which avoids reserializing chat history shared with other
+        # distributions. Note '"messages": []' can only match the key itself,
+        # since quotes inside json strings are escaped.
+        data = self.json()
+        data["dict"]["messages"] = []
+        head, sep, tail = canonical_json(data).partition('"messages": []')
+        assert sep
+        messages = _messages_json(self.messages)
+        prefix = "[" + head + '"messages": ' + messages + tail + ", "
+        return hashlib.sha256(prefix.encode("utf-8"))
+
     async def sample(self, rng: RandomKey) -> str:
         # Form a request.
         # https://platform.openai.com/docs/api-reference/chat/create?lang=python
         request: Dict[str, Any] = dict(
-            messages=self.messages,
+            messages=list(self.messages),
             model=self.model,
             temperature=self.temperature,
         )
         if self.max_tokens is not None:
             request["max_tokens"] = self.max_tokens
 
-        # Call the async non-streaming API.
-        raw_response = await openai.ChatCompletion.acreate(**request)
+        # Call the API, coalescing with any identical concurrent requests.
+        choice = await BATCHER.create(request)
 
         # Parse the response.
-        response: dict = raw_response.to_dict_recursive()
-        if any(c["finish_reason"] == "length" for c in response["choices"]):
+        if choice["finish_reason"] == "length":
             logger.warning("Chat was truncated")
-        text: str = response["choices"][0]["message"]["content"]
+        text: str = choice["message"]["content"]
         return text
 
 
 SYSTEM_PROMPT = """You are Hercule Pyrot, the brilliant detective who has listened in to the conversations of multiple speakers."""
 
 
-def render_messages(messages: Chat) -> str:
-    lines: List[str] = []
-    for message in messages:
-        role = message["role"]
-        content = message["content"]
-        lines.append(f"{role.capitalize()}:")
-        for line in textwrap.wrap(content, width=76):
-            lines.append(f"    {line}")
+@functools.lru_cache(maxsize=4096)
+def _render_message(role: str, content: str) -> str:
+    lines = [f"{role.capitalize()}:"]
+    for line in textwrap.wrap(content, width=76):
+        lines.append(f"    {line}")
     return "\n".join(lines)
 
 
+def render_messages(messages: Sequence[ChatMessage]) -> str:
+    # Messages are rendered individually and cached, since under Gibbs sampling
+    # each side conversation recurs in many FusedGPT prompts.
+    return "\n".join(_render_message(m["role"], m["content"]) for m in messages)
+
+
 class FusedGPT(Distribution[str]):
     """
     Corresponds to the complete conditional probabiltic model::
@@ -113,25 +300,30 @@ class FusedGPT(Distribution[str]):
 
     VARIABLE = "MYSTERY_UTTERANCE"
 
-    def __init__(self, prior: Chat, likelihoods: List[Chat]) -> None:
+    prior: Tuple[ChatMessage, ...]
+    likelihoods: Tuple[Tuple[ChatMessage, ...], ...]
+
+    def __init__(
+        self, prior: Sequence[ChatMessage], likelihoods: Sequence[Sequence[ChatMessage]]
+    ) -> None:
         super().__init__()
-        self.prior = copy.deepcopy(prior)
-        self.likelihoods = copy.deepcopy(likelihoods)
+        self.prior = tuple(map(copy.copy, prior))
+        self.likelihoods = tuple(tuple(map(copy.copy, L)) for L in likelihoods)
 
     async def sample(self, rng: RandomKey) -> str:
         assert self.prior[-1]["role"] == "user", self.prior[-1]["role"]
-        messages = self.prior + [assistant("MYSTERY_UTTERANCE")]
+        messages = list(self.prior) + [assistant("MYSTERY_UTTERANCE")]
         question = f"""The conversation starts like this:
 
 {render_messages(messages)}
 
 Now after the MYSTERY_UTTERANCE you heard {len(self.likelihoods)} side conversations."""
-        for messages in self.likelihoods:
+        for likelihood in self.likelihoods:
             question += f"""
 
 One side conversation went like this:
 
-{render_messages(messages)}
+{render_messages(likelihood)}
 """
         question += """Your task now, Hercule Pyrot, is to guess MYSTERY_UTTERANCE. Please write your best guess below, exactly as it would have appeared in the conversation."""
         messages = [system(SYSTEM_PROMPT), user(question)]
@@ -1,12 +1,43 @@
 import hashlib
 import json
 import struct
-from typing import NamedTuple, Tuple
+from typing import Any, Callable, Tuple
+
+try:
+    import orjson
+
+    HAVE_ORJSON = True
+except ImportError:
+    HAVE_ORJSON = False
+
+try:
+    import xxhash
+
+    HAVE_XXHASH = True
+except ImportError:
+    HAVE_XXHASH = False
+
+
+# Serializes data to canonical json, exactly as json.dumps(data, sort_keys=True)
+# does, but without constructing a new encoder per call. Since this feeds
+# persistent keys, its output must remain stable.
+canonical_json: Callable[[Any], str] = json.JSONEncoder(sort_keys=True).encode
 
 
 def hash_text(text: str) -> int:
-    """Deterministically hashes a string into a fixed width int."""
-    sha256 = hashlib.sha256(text.encode("utf-8"))
+    """
+    Deterministically hashes a string into a fixed width int.
+
+    This is used for persistent keys, e.g. in MemoizeSqlite, so its output must
+    remain stable. For in-memory hashing prefer :func:`fast_hash_text`.
+    """
+    # Note hashlib.sha256 is backed by OpenSSL, which uses the SHA extensions
+    # of x86 and ARMv8 CPUs where available. Prefer it over hashlib.new().
+    return hash_sha256(hashlib.sha256(text.encode("utf-8")))
+
+
+def hash_sha256(sha256: "hashlib._Hash") -> int:
+    """Converts a sha256 hash object to a fixed width int, as in hash_text."""
     hash_bytes = sha256.digest()
     hash_int: int = struct.unpack("<q", hash_bytes[:8])[0]
     return hash_int
@@ -14,16 +45,105 @@ def hash_text(text: str) -> int:
 
 def hash_json(data) -> int:
     """Deterministically hashes data into a fixed width int."""
-    data_json = json.dumps(data, sort_keys=True)
+    data_json = canonical_json(data)
     int_hash: int = hash_text(data_json)
     return int_hash
 
 
-class RandomKey(NamedTuple):
-    """Immutable random state."""
+def _blake2b_intdigest(data: bytes) -> int:
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "little")
+
+
+# Quickly hashes bytes into a fixed width int.
+#
+# This uses xxh3 if the ``xxhash`` package is installed, falling back to
+# blake2b. Since results differ between the two, this must only be used for
+# in-memory hashing, never for persistent keys. The implementation is bound
+# directly, to avoid the cost of a Python-level wrapper call.
+fast_hash_bytes: Callable[[bytes], int] = (
+    xxhash.xxh3_64_intdigest if HAVE_XXHASH else _blake2b_intdigest
+)
+
+
+def fast_hash_text(text: str) -> int:
+    """Quickly hashes a string into a fixed width int, for in-memory use."""
+    return fast_hash_bytes(text.encode("utf-8"))
+
+
+def fast_hash_json(data) -> int:
+    """
+    Quickly hashes data into a fixed width int, for in-memory use.
+
+    This serializes via ``orjson`` if installed, falling back to ``json`` for
+    data that ``orjson`` does not support, e.g. ints wider than 64 bits.
+    """
+    if HAVE_ORJSON:
+        options = orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS
+        try:
+            data_bytes = orjson.dumps(data, option=options)
+        except TypeError:
+            pass
+        else:
+            return fast_hash_bytes(data_bytes)
+    return fast_hash_text(canonical_json(data))
+
+
+MASK64 = 0xFFFFFFFFFFFFFFFF
+
+
+class RandomKey:
+    """
+    Immutable random state.
+
+    This is a linked list of ints ``(head, tail)``. Its hash is computed once
+    at construction from the tail's hash, so hashing is O(1). Tails are shared
+    between keys, so :meth:`split` is O(1) in time and memory. Note the list
+    structure is retained because :meth:`json` is part of persisted
+    MemoizeSqlite keys.
+    """
+
+    __slots__ = ("head", "tail", "_hash")
+
+    head: int
+    tail: "RandomKey | None"
+    _hash: int
+
+    def __init__(self, head: int = 0, tail: "RandomKey | None" = None) -> None:
+        self.head = head
+        self.tail = tail
+        # Tuple hashing of ints is deterministic and mixes well, in C.
+        self._hash = hash((head, 0 if tail is None else tail._hash)) & MASK64
+
+    def __hash__(self) -> int:
+        return self._hash
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, RandomKey):
+            return NotImplemented
+        # Walk both lists iteratively, stopping early at shared tails.
+        a: RandomKey | None = self
+        b: RandomKey | None = other
+        while a is not b:
+            if a is None or b is None or a._hash != b._hash or a.head != b.head:
+                return False
+            a, b = a.tail, b.tail
+        return True
+
+    def __repr__(self) -> str:
+        return f"RandomKey(head={self.head!r}, tail={self.tail!r})"
 
-    head: int = 0
-    tail: "RandomKey | None" = None
+    def json(self) -> list:
+        """Converts self to json-serializable format ``[head, tail]``."""
+        heads = []
+        key: RandomKey | None = self
+        while key is not None:
+            heads.append(key.head)
+            key = key.tail
+        result: list | None = None
+        for head in reversed(heads):
+            result = [head, result]
+        assert result is not None
+        return result
 
     def split(self) -> Tuple["RandomKey", "RandomKey"]:
         """
@@ -12,5 +12,8 @@ setup(
     author="Pyro Contributors",
     python_requires=">=3.10",
     install_requires=open("requirements.txt").read().strip().split(),
-    extras_require={"test": open("requirements-dev.txt").read().strip().split()},
+    extras_require={
+        "fast": ["orjson", "xxhash"],
+        "test": open("requirements-dev.txt").read().strip().split(),
+    },
 )
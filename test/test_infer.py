@@ -1,13 +1,31 @@
+import asyncio
+import functools
 import logging
+import random
+import sys
+from typing import Dict, List
 
+import openai
 import pytest
+import pytest_asyncio
 
 import lyro
 from lyro.infer import Gibbs
-from lyro.openai import ChatGPT, assistant, system, user
+from lyro.interpreters import (
+    Condition,
+    Memoize,
+    ThreadRandomKey,
+    Trace,
+    set_interpreter,
+)
+from lyro.openai import BATCHER, ChatGPT, FusedGPT, assistant, system, user
 
 logger = logging.getLogger(__name__)
 
+requires_eager = pytest.mark.skipif(
+    sys.version_info < (3, 12), reason="eager tasks require Python 3.12+"
+)
+
 
 async def alice_bob_model(num_steps: int = 5):
     alice = [
@@ -37,7 +55,7 @@ async def alice_bob_model(num_steps: int = 5):
 
 
 @pytest.mark.asyncio
-async def test_gibbs_ab():
+async def test_gibbs_ab(fake_api):
     data = {"b_4": "You've convinced me, tabs are better than spaces."}
     gibbs = Gibbs(alice_bob_model, data)
 
@@ -98,7 +116,7 @@ async def book_model(dynamic: bool = False):
 
 
 @pytest.mark.asyncio
-async def test_gibbs_book():
+async def test_gibbs_book(fake_api):
     data = {"title": "Pyro meets its new little sibling, Lyro"}
     markov_blanket = {
         "book": ["title", "summary", "moral"],
@@ -113,3 +131,284 @@ async def test_gibbs_book():
     assert isinstance(sample, dict)
     expected = {"summary", "book", "moral"}
     assert set(sample) == expected
+
+
+class FakeResponse:
+    def __init__(self, choices):
+        self.choices = choices
+
+    def to_dict_recursive(self):
+        choices = [
+            {"finish_reason": "stop", "message": {"content": content}}
+            for content in self.choices
+        ]
+        return {"choices": choices}
+
+
+class FakeAPI:
+    def __init__(self):
+        self.requests = []
+        self.replies = []
+        self.inflight = 0
+        self.peak_inflight = 0
+        self.delay = lambda: 0.001
+
+    async def acreate(self, **request):
+        self.requests.append(request)
+        count = len(self.requests)
+        choices = [f"reply {count}.{i}" for i in range(request.get("n", 1))]
+        self.replies.append(choices)
+        self.inflight += 1
+        self.peak_inflight = max(self.peak_inflight, self.inflight)
+        try:
+            await asyncio.sleep(self.delay())
+        finally:
+            self.inflight -= 1
+        return FakeResponse(choices)
+
+
+@pytest_asyncio.fixture
+async def fake_api(monkeypatch):
+    # Memoize in memory, so that fake replies never reach data/test.db.
+    set_interpreter(Memoize() + ThreadRandomKey())
+    api = FakeAPI()
+    monkeypatch.setattr(openai.ChatCompletion, "acreate", api.acreate)
+    yield api
+    await BATCHER.aclose()
+
+
+async def independent_model(num_sites: int = 4):
+    return [
+        await lyro.sample(f"x_{i}", ChatGPT([user(f"Say {i}.")]))
+        for i in range(num_sites)
+    ]
+
+
+def independent_blanket(num_sites: int = 4):
+    return {f"x_{i}": [] for i in range(num_sites)}
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("eager", [False, pytest.param(True, marks=requires_eager)])
+async def test_gibbs_error(fake_api, eager):
+    failing = True
+
+    async def model():
+        x = await independent_model()
+        if failing and x[0] == FusedGPT.VARIABLE:
+            raise ValueError("expected")
+
+    markov_blanket = independent_blanket()
+    gibbs = Gibbs(model, {}, markov_blanket=markov_blanket, eager=eager)
+    with pytest.raises(ValueError, match="expected"):
+        await gibbs.sample(num_steps=4)
+
+    # Other steps should be cancelled and awaited.
+    assert gibbs._running_mask == 0
+    assert gibbs.tasks == [None] * 4
+    assert fake_api.inflight == 0
+
+    # Inference should be able to resume.
+    failing = False
+    sample = await gibbs.sample(num_steps=4)
+    assert set(sample) == set(markov_blanket)
+
+
+async def chain_model():
+    x = await lyro.sample("x", ChatGPT([user("Say something.")]))
+    y = await lyro.sample("y", ChatGPT([user(f"Reply to: {x}")]))
+    await lyro.sample("z", ChatGPT([user(f"Reply to: {y}")]))
+
+
+@pytest.mark.asyncio
+async def test_gibbs_likelihoods_updated(fake_api):
+    gibbs = Gibbs(chain_model, {})
+
+    # Step sites z, y, x, then z again.
+    await gibbs.sample(num_steps=4)
+    init_x = fake_api.replies[0][0]
+    step_x = fake_api.replies[-2][0]
+    assert gibbs._values["x"] == step_x != init_x
+
+    # The last step should see the updated x in the likelihood of y.
+    question = fake_api.requests[-1]["messages"][-1]["content"]
+    assert f"Reply to: {step_x}" in question
+    assert f"Reply to: {init_x}" not in question
+
+
+@pytest.mark.asyncio
+async def test_gibbs_step_updates_trace(fake_api):
+    gibbs = Gibbs(chain_model, {})
+
+    # A single step at site z should change the sample.
+    sample = await gibbs.sample(num_steps=1)
+    init_z = fake_api.replies[2][0]
+    assert sample["z"] == fake_api.replies[-1][0] != init_z
+
+    # Steps should leave the trace consistent with the sampled values.
+    sample = await gibbs.sample(num_steps=4)
+    with Condition(sample), Trace() as trace:
+        await chain_model()
+    for name, node in gibbs.trace.nodes.items():
+        assert node.value == sample[name]
+        assert node.distribution == trace.nodes[name].distribution
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("eager", [False, pytest.param(True, marks=requires_eager)])
+@pytest.mark.parametrize("max_inflight", [1, 2, 8])
+async def test_gibbs_max_inflight(fake_api, max_inflight, eager):
+    fake_api.delay = lambda: 0.02  # Overlap steps whenever they can.
+    model = functools.partial(independent_model, 8)
+    markov_blanket = independent_blanket(8)
+    gibbs = Gibbs(
+        model, {}, markov_blanket=markov_blanket, eager=eager, max_inflight=max_inflight
+    )
+
+    await gibbs.sample(num_steps=8)
+    assert fake_api.peak_inflight == max_inflight
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("eager", [False, pytest.param(True, marks=requires_eager)])
+async def test_gibbs_cancel(fake_api, eager):
+    markov_blanket = independent_blanket()
+    gibbs = Gibbs(independent_model, {}, markov_blanket=markov_blanket, eager=eager)
+
+    # Cancel while steps are running.
+    task = asyncio.create_task(gibbs.sample(num_steps=8))
+    while not getattr(gibbs, "_running_mask", 0):
+        await asyncio.sleep(0)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    assert gibbs._running_mask == 0
+    assert gibbs.tasks == [None] * 4
+
+    # Inference should be able to resume.
+    sample = await gibbs.sample(num_steps=8)
+    assert set(sample) == set(markov_blanket)
+
+
+@pytest.mark.asyncio
+async def test_gibbs_likelihood_cache(fake_api):
+    num_runs = 0
+
+    async def model():
+        nonlocal num_runs
+        num_runs += 1
+        await independent_model(2)
+
+    gibbs = Gibbs(model, {}, markov_blanket=independent_blanket(2))
+    await gibbs.sample(num_steps=6)
+
+    # Reruns for the likelihoods of unchanged blankets should be cached.
+    assert num_runs == 1 + 2  # The prior, then one rerun per site.
+
+
+def reference_find_work(gibbs):
+    """Picks work by the original ``min((count, rank))`` rule, over names."""
+    counts = {name: gibbs.counts[i] for i, name in enumerate(gibbs._names)}
+    slowest = min((c for c in counts.values() if c), default=0)  # started sites
+    running = {
+        name for i, name in enumerate(gibbs._names) if gibbs._running_mask >> i & 1
+    }
+    feasible = [
+        name
+        for name, deps in gibbs.markov_blanket.items()
+        if name not in running  # don't duplicate work
+        if not any(dep in running for dep in deps)  # avoid conflict
+        if counts[name] <= slowest  # don't get too far ahead
+    ]
+    return min(feasible, key=lambda n: (counts[n], gibbs.rank[n]), default=None)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("eager", [False, pytest.param(True, marks=requires_eager)])
+@pytest.mark.parametrize("seed", range(5))
+async def test_gibbs_schedule(fake_api, monkeypatch, seed, eager):
+    r = random.Random(seed)
+    fake_api.delay = lambda: r.random() * 0.002
+
+    # Draw a random symmetric Markov blanket.
+    names = [f"x_{i}" for i in range(6)]
+    markov_blanket: Dict[str, List[str]] = {name: [] for name in names}
+    for i, a in enumerate(names):
+        for b in names[:i]:
+            if r.random() < 0.3:
+                markov_blanket[a].append(b)
+                markov_blanket[b].append(a)
+    model = functools.partial(independent_model, 6)
+    gibbs = Gibbs(model, {}, markov_blanket=markov_blanket, eager=eager)
+
+    # Check each scheduling decision against the original rule.
+    decisions = []
+    find_work = gibbs._find_work
+
+    def checked_find_work():
+        expected = reference_find_work(gibbs)
+        i = find_work()
+        assert (None if i is None else gibbs._names[i]) == expected
+        decisions.append(expected)
+        return i
+
+    monkeypatch.setattr(gibbs, "_find_work", checked_find_work)
+    for num_steps in [5, 20]:
+        await gibbs.sample(num_steps=num_steps)
+    assert sum(d is not None for d in decisions) == 25
+
+
+@pytest.mark.asyncio
+async def test_gibbs_no_feasible_work(fake_api):
+    # With every site observed, no step is ever feasible. As before the
+    # completion future, sample() should then fail fast rather than hang.
+    model = functools.partial(independent_model, 2)
+    gibbs = Gibbs(model, {"x_0": "hello", "x_1": "goodbye"})
+    with pytest.raises(AssertionError):
+        await asyncio.wait_for(gibbs.sample(num_steps=3), timeout=1.0)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("seed", range(3))
+async def test_gibbs_asymmetric_blanket(fake_api, monkeypatch, seed):
+    r = random.Random(seed)
+    fake_api.delay = lambda: r.random() * 0.002
+    markov_blanket = {"x": [], "y": ["x"], "z": ["y"]}
+    gibbs = Gibbs(chain_model, {}, markov_blanket=markov_blanket)
+
+    # A site should never run concurrently with a site whose blanket has it.
+    find_work = gibbs._find_work
+
+    def checked_find_work():
+        i = find_work()
+        if i is not None:
+            name = gibbs._names[i]
+            for j, other in enumerate(gibbs._names):
+                if gibbs._running_mask >> j & 1:
+                    assert name not in markov_blanket[other]
+                    assert other not in markov_blanket[name]
+        return i
+
+    monkeypatch.setattr(gibbs, "_find_work", checked_find_work)
+    sample = await gibbs.sample(num_steps=12)
+
+    # Steps should leave the trace consistent with the sampled values.
+    with Condition(sample), Trace() as trace:
+        await chain_model()
+    for name, node in gibbs.trace.nodes.items():
+        assert node.distribution == trace.nodes[name].distribution
+
+
+@pytest.mark.asyncio
+async def test_gibbs_likelihood_cache_grandparent(fake_api):
+    markov_blanket = {"x": ["y"], "y": ["x", "z"], "z": ["y"]}
+    gibbs = Gibbs(chain_model, {}, markov_blanket=markov_blanket)
+    await gibbs.sample(num_steps=0)
+    x = gibbs._values["x"]
+    [messages] = await gibbs.get_likelihoods("z", FusedGPT.VARIABLE)
+    assert messages[-1]["content"] == f"Reply to: {x}"
+
+    # Changing the grandparent x of z should change the prompt of y.
+    gibbs._values["x"] = "NEW X"
+    [messages] = await gibbs.get_likelihoods("z", FusedGPT.VARIABLE)
+    assert messages[-1]["content"] == "Reply to: NEW X"
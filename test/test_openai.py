@@ -0,0 +1,94 @@
+import asyncio
+
+import openai
+import pytest
+
+from lyro.openai import BATCHER, ChatGPT, user
+from lyro.random import RandomKey
+
+
+class FakeResponse:
+    def __init__(self, request):
+        self.request = request
+
+    def to_dict_recursive(self):
+        n = self.request.get("n", 1)
+        choices = [
+            {"finish_reason": "stop", "message": {"content": f"choice {i}"}}
+            for i in range(n)
+        ]
+        return {"choices": choices}
+
+
+@pytest.fixture
+def api_requests(monkeypatch):
+    api_requests = []
+
+    async def acreate(**request):
+        api_requests.append(request)
+        return FakeResponse(request)
+
+    monkeypatch.setattr(openai.ChatCompletion, "acreate", acreate)
+    return api_requests
+
+
+@pytest.mark.asyncio
+async def test_chatgpt_batching(api_requests):
+    rngs = [RandomKey(i) for i in range(4)]
+    same = ChatGPT([user("hello")])
+    other = ChatGPT([user("goodbye")])
+    results = await asyncio.gather(
+        *[same.sample(rng) for rng in rngs[:3]], other.sample(rngs[3])
+    )
+
+    assert len(api_requests) == 2
+    assert api_requests[0]["n"] == 3
+    assert "n" not in api_requests[1]
+    assert sorted(results[:3]) == ["choice 0", "choice 1", "choice 2"]
+    assert results[3] == "choice 0"
+    await BATCHER.aclose()
+
+
+@pytest.mark.asyncio
+async def test_chatgpt_max_batch(api_requests, monkeypatch):
+    monkeypatch.setattr(BATCHER, "max_batch", 2)
+    same = ChatGPT([user("hello")])
+    results = await asyncio.gather(*[same.sample(RandomKey(i)) for i in range(5)])
+
+    assert [r.get("n") for r in api_requests] == [2, 2, None]
+    assert len(results) == 5
+    await BATCHER.aclose()
+
+
+def test_chatgpt_closed_loop(api_requests):
+    same = ChatGPT([user("hello")])
+
+    # Time out within the batching window, closing the loop.
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(asyncio.wait_for(same.sample(RandomKey(0)), 0.001))
+
+    # Identical requests on a new loop should not join the stale batch.
+    result = asyncio.run(asyncio.wait_for(same.sample(RandomKey(1)), 1.0))
+    assert result == "choice 0"
+    assert len(api_requests) == 1
+
+
+def test_chatgpt_session(api_requests):
+    async def main():
+        await ChatGPT([user("hello")]).sample(RandomKey(0))
+        session, _ = BATCHER._sessions[asyncio.get_running_loop()]
+        return session
+
+    # The loop's session should be closed when the loop shuts down.
+    session = asyncio.run(main())
+    assert session.closed
+    assert not BATCHER._sessions
+
+
+def test_chatgpt_messages_copied():
+    x = ChatGPT([user("hello")])
+    key = x.key_hash(RandomKey(0))
+    x.messages[0]["content"] = "goodbye"
+    y = ChatGPT([user("hello")])
+    assert y.messages[0]["content"] == "hello"
+    assert y.key_hash(RandomKey(0)) == key
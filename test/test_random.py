@@ -0,0 +1,27 @@
+import json
+
+from lyro.random import RandomKey
+
+
+def test_random_key_split():
+    rng = RandomKey()
+    new, rng = rng.split()
+    assert new == RandomKey(0, RandomKey())
+    assert rng == RandomKey(1)
+    assert new != rng
+    assert hash(new) != hash(rng)
+
+    # Equal keys hash equally, regardless of how they were constructed.
+    _, rng2 = RandomKey(0).split()
+    assert rng2 == rng
+    assert hash(rng2) == hash(rng)
+
+
+def test_random_key_json():
+    # The json format is persisted in MemoizeSqlite keys, so must not change.
+    rng = RandomKey()
+    new, rng = rng.split()
+    new, _ = new.split()
+    assert new.json() == [0, [0, [0, None]]]
+    assert rng.json() == [1, None]
+    assert json.dumps(new.json()) == "[0, [0, [0, null]]]"
@@ -1,11 +1,24 @@
+import asyncio
+import hashlib
+import json
 import logging
+import sqlite3
 
 import pytest
 
 import lyro
 from lyro.distributions import UniformHash
-from lyro.interpreters import ThreadRandomKey
+from lyro.interpreters import (
+    Condition,
+    Memoize,
+    MemoizeSqlite,
+    Standard,
+    ThreadRandomKey,
+    get_interpreter,
+    set_interpreter,
+)
 from lyro.openai import ChatGPT, assistant, system, user
+from lyro.random import RandomKey, hash_json
 
 logger = logging.getLogger(__name__)
 
@@ -17,6 +30,135 @@ async def hash_model():
     return x
 
 
+@pytest.mark.asyncio
+@pytest.mark.parametrize("param", [None, "foo", {"b": [1, 2], "a": "bar"}])
+async def test_uniform_hash(param):
+    rng, _ = RandomKey(3).split()
+    text = json.dumps((param, rng.json()), sort_keys=True)
+    expected = hashlib.sha256(text.encode("utf-8")).hexdigest()
+    assert await UniformHash(param).sample(rng) == expected
+
+
+@pytest.mark.parametrize(
+    "distribution",
+    [
+        UniformHash(),
+        UniformHash({"foo": [1, 2]}),
+        ChatGPT([user("hi")], max_tokens=9),
+        ChatGPT([system('Say "messages": []'), user("héllo"), assistant("hi")]),
+        ChatGPT(json.loads('[{"role": "user", "name": "bob"}, {"role": "user"}]')),
+    ],
+)
+def test_key_hash(distribution):
+    for rng in [RandomKey(), RandomKey(2, RandomKey(1))]:
+        expected = hash_json((distribution.json(), rng.json()))
+        assert distribution.key_hash(rng) == expected
+
+
+@pytest.mark.asyncio
+async def test_memoize():
+    memoize = Memoize()
+    set_interpreter(Standard() + memoize + ThreadRandomKey())
+    x = await hash_model()
+    assert len(memoize.cache) == 10
+    y = await hash_model()
+    assert len(memoize.cache) == 20
+    with ThreadRandomKey():
+        z = await hash_model()
+    assert len(memoize.cache) == 20
+    assert x != y
+    assert x == z
+
+
+class SlowCount(UniformHash):
+    async def sample(self, rng):
+        self._count = getattr(self, "_count", 0) + 1
+        await asyncio.sleep(0.01)
+        return await super().sample(rng)
+
+
+@pytest.mark.asyncio
+async def test_memoize_coalesce():
+    memoize = Memoize()
+    distribution = SlowCount("foo")
+    rng = RandomKey()
+    x, y = await asyncio.gather(
+        memoize.sample("x", distribution, rng),
+        memoize.sample("x", distribution, rng),
+    )
+    assert x == y
+    assert distribution._count == 1
+
+
+@pytest.mark.asyncio
+async def test_memoize_probability():
+    memoize = Memoize(probability=0.5)
+    set_interpreter(Standard() + memoize + ThreadRandomKey())
+    await hash_model()
+    assert len(memoize.cache) == 5
+
+
+@pytest.mark.asyncio
+async def test_memoize_sqlite(tmp_path):
+    dbname = str(tmp_path / "test.db")
+    memoize = MemoizeSqlite(dbname)
+    set_interpreter(memoize + ThreadRandomKey())
+    x = await hash_model()
+    memoize.flush()
+    with sqlite3.connect(dbname) as conn:
+        row = conn.execute("SELECT COUNT(*) FROM key_value").fetchone()
+    assert row[0] == 10
+
+    # Results should be reused by a fresh interpreter.
+    set_interpreter(MemoizeSqlite(dbname) + ThreadRandomKey())
+    y = await hash_model()
+    assert x == y
+
+
+def test_memoize_sqlite_closed_loop(tmp_path):
+    def count_rows():
+        with sqlite3.connect(dbname) as conn:
+            return conn.execute("SELECT COUNT(*) FROM key_value").fetchone()[0]
+
+    # Stop and close a loop before it writes results, e.g. on Ctrl-C.
+    async def interrupted_model():
+        await hash_model()
+        asyncio.get_running_loop().stop()
+
+    dbname = str(tmp_path / "test.db")
+    memoize = MemoizeSqlite(dbname)
+    set_interpreter(memoize + ThreadRandomKey())
+    loop = asyncio.new_event_loop()
+    loop.create_task(interrupted_model())
+    loop.run_forever()
+    loop.close()
+    assert count_rows() == 0
+
+    # Results from later loops should be saved by their own flush callbacks.
+    asyncio.run(hash_model())
+    assert count_rows() == 20
+
+    # Results should be saved on close, even those left by a closed loop.
+    loop = asyncio.new_event_loop()
+    loop.create_task(interrupted_model())
+    loop.run_forever()
+    loop.close()
+    memoize.close()
+    assert count_rows() == 30
+
+
+@pytest.mark.asyncio
+async def test_interpreter_context():
+    async def worker(value):
+        with Condition({"x": value}):
+            await asyncio.sleep(0)  # Let the other worker enter its Condition.
+            return await lyro.sample("x", UniformHash())
+
+    outer = get_interpreter()
+    assert await asyncio.gather(worker(1), worker(2)) == [1, 2]
+    assert get_interpreter() is outer
+
+
 async def alice_bob_model():
     alice = [
         system("You try to persuade the user that tabs are better than spaces."),